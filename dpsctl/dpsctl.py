@@ -35,38 +35,32 @@ time, add it tht the environment variable DPSIF.
 
 """
 
-import argparse
 import sys
 import os
 import socket
-try:
-    import serial
-except:
-    print("Missing dependency pyserial:")
-    print(" sudo pip%s install pyserial" % ("3" if sys.version_info.major == 3 else ""))
-    raise SystemExit()
-import threading
 import time
-from uhej import uhej
 from protocol import *
 import uframe
 import binascii
-try:
-    from PyCRC.CRCCCITT import CRCCCITT
-except:
-    print("Missing dependency pycrc:")
-    print(" sudo pip%s install pycrc" % ("3" if sys.version_info.major == 3 else ""))
-    raise SystemExit()
-import json
+
+# Modules only some commands need (pyserial, uhej, json, threading...) are
+# imported where they are used to keep startup fast.
 
 parameters = []
 
+# Enables options only used for testing the firmware (eg. --temperature)
+TESTING = '--testing' in sys.argv or bool(os.environ.get("DPSCTL_TESTING"))
+
+_SOF_BYTE = bytearray([uframe._SOF])
+_EOF_BYTE = bytearray([uframe._EOF])
+
 """
 An abstract class that describes a communication interface
 """
 class comm_interface(object):
 
     _if_name = None
+    _warning = None
 
     def __init__(self, if_name):
         self._if_name = if_name
@@ -77,6 +71,9 @@ class comm_interface(object):
     def close(self):
         return False
 
+    def is_open(self):
+        return False
+
     def write(self, bytes):
         return False
 
@@ -86,47 +83,83 @@ class comm_interface(object):
     def name(self):
         return self._if_name
 
+    """
+    Return a note about something that did not go as planned when the
+    interface was opened, or None
+    """
+    def warning(self):
+        return self._warning
+
 """
 A class that describes a serial interface
 """
 class tty_interface(comm_interface):
 
     _port_handle = None
+    _rx_buffer = None
 
     def __init__(self, if_name):
         self._if_name = if_name
+        self._rx_buffer = bytearray()
 
     def open(self):
+        try:
+            import serial
+        except ImportError:
+            print("Missing dependency pyserial:")
+            print(" sudo pip%s install pyserial" % ("3" if sys.version_info.major == 3 else ""))
+            raise SystemExit()
         self._port_handle = serial.Serial(baudrate = 115200, timeout = 1.0)
         self._port_handle.port = self._if_name
         self._port_handle.open()
+        # USB serial adapters (FTDI in particular) hold on to received data
+        # for up to 16ms, which dominates the round trip time of our frames
+        self._warning = None
+        try:
+            self._port_handle.set_low_latency_mode(True)
+        except (AttributeError, NotImplementedError):
+            pass # Old pyserial or not supported on this platform
+        except (IOError, ValueError) as e:
+            self._warning = "could not enable low latency mode on %s (%s)" % (self._if_name, e)
+        self._rx_buffer = bytearray()
         return True
 
     def close(self):
-        self._port_handle.port.close()
-        self._port_handle = None
+        if self._port_handle:
+            self._port_handle.close()
+            self._port_handle = None
         return True
 
+    def is_open(self):
+        return self._port_handle is not None
+
     def write(self, bytes):
         self._port_handle.write(bytes)
         return True
 
+    """
+    Read whatever the port has buffered in one go and cut the first complete
+    frame out of it. Any trailing bytes are kept for the next call.
+    """
     def read(self):
-        bytes = bytearray()
-        sof = False
         while True:
-            b = self._port_handle.read(1)
-            if not b: # timeout
-                break
-            b = ord(b)
-            if b == uframe._SOF:
-                bytes = bytearray()
-                sof = True
-            if sof:
-                bytes.append(b)
-            if b == uframe._EOF:
-                break
-        return bytes
+            eof = self._rx_buffer.find(_EOF_BYTE)
+            if eof >= 0:
+                sof = self._rx_buffer.rfind(_SOF_BYTE, 0, eof)
+                frame = self._rx_buffer[sof:eof + 1] if sof >= 0 else None
+                del self._rx_buffer[:eof + 1]
+                if frame:
+                    return frame
+                continue # EOF without SOF, keep looking
+            sof = self._rx_buffer.rfind(_SOF_BYTE)
+            if sof < 0:
+                del self._rx_buffer[:]
+            elif sof > 0:
+                del self._rx_buffer[:sof]
+            data = self._port_handle.read(max(1, self._port_handle.in_waiting))
+            if not data: # timeout
+                return bytearray()
+            self._rx_buffer.extend(data)
 
 """
 A class that describes a UDP interface
@@ -134,36 +167,45 @@ A class that describes a UDP interface
 class udp_interface(comm_interface):
 
     _socket = None
+    _rx_buffer = None
 
     def __init__(self, if_name):
         self._if_name = if_name
+        self._rx_buffer = bytearray(1500)
 
     def open(self):
         try:
             self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
             self._socket.settimeout(1.0)
+            # We only ever talk to one device, connecting lets us use send/recv
+            self._socket.connect((self._if_name, 5005))
         except socket.error:
             return False
         return True
 
     def close(self):
-        self._socket.close()
-        self._socket = None
+        if self._socket:
+            self._socket.close()
+            self._socket = None
         return True
 
+    def is_open(self):
+        return self._socket is not None
+
     def write(self, bytes):
         try:
-            self._socket.sendto(bytes, (self._if_name, 5005))
+            self._socket.send(bytes)
         except socket.error as msg:
-            fail("%s (%d)" % (str(msg[0]), msg[1]))
+            fail("write failed on %s: %s" % (self._if_name, msg))
         return True
 
     def read(self):
         reply = bytearray()
         try:
-            d = self._socket.recvfrom(1000)
-            reply = bytearray(d[0])
-            addr = d[1]
+            length = self._socket.recv_into(self._rx_buffer)
+            reply = self._rx_buffer[:length]
         except socket.timeout:
             pass
         except socket.error:
@@ -178,31 +220,180 @@ def fail(message):
         sys.exit(1)
 
 
+# Unit names (must of course match unit_t in opendps/uui.h)
+_UNITS = {
+    0: "A",
+    1: "V",
+    2: "W",
+    3: "s",
+    4: "Hz",
+}
+
+# SI prefixes
+_PREFIXES = {
+    -6: "u",
+    -3: "m",
+    -2: "c",
+    -1: "d", # TODO: is this correct (deci?
+     0: "",
+     1: "D", # TODO: is this correct (deca)?
+     2: "hg",
+     3: "k",
+     4: "M",
+}
+
+# Result of setting a parameter, indexed by the status the device returns
+_PARAM_STATUS = ("ok", "unknown parameter", "out of range", "unsupported parameter")
+
 """
-Return name of unit (must of course match unit_t in opendps/uui.h)
+Return name of unit
 """
 def unit_name(unit):
-    if unit == 0: return "A"
-    if unit == 1: return "V"
-    if unit == 2: return "W"
-    if unit == 3: return "s"
-    if unit == 4: return "Hz"
-    return "unknown"
+    return _UNITS.get(unit, "unknown")
 
 """
 Return SI prefix
 """
 def prefix_name(prefix):
-    if prefix == -6: return "u"
-    if prefix == -3: return "m"
-    if prefix == -2: return "c"
-    if prefix == -1: return "d" # TODO: is this correct (deci?
-    if prefix ==  0: return ""
-    if prefix ==  1: return "D" # TODO: is this correct (deca)?
-    if prefix ==  2: return "hg"
-    if prefix ==  3: return "k"
-    if prefix ==  4: return "M"
-    return "e%d" % prefix
+    name = _PREFIXES.get(prefix)
+    return name if name is not None else "e%d" % prefix
+
+"""
+Handlers for response frames from the device, one per command. Each handler
+unpacks the frame and fills in ret_dict (returned to the caller of
+communicate) and json_dict (printed when --json is given).
+"""
+def handle_ping_response(frame, args, ret_dict, json_dict):
+    print("Got pong from device")
+
+def handle_cal_report_response(frame, args, ret_dict, json_dict):
+    ret_dict.update(unpack_cal_report(frame))
+
+def handle_query_response(frame, args, ret_dict, json_dict):
+    data = unpack_query_response(frame)
+    if args.json:
+        json_dict.clear()
+        json_dict.update(data)
+    else:
+        enable_str = "on" if data['output_enabled'] else "temperature shutdown" if data['temp_shutdown'] == 1 else "off"
+        v_in_str = "%d.%02d" % (data['v_in']/1000, (data['v_in']%1000)/10)
+        v_out_str = "%d.%02d" % (data['v_out']/1000, (data['v_out']%1000)/10)
+        i_out_str = "%d.%03d" % (data['i_out']/1000, data['i_out']%1000)
+        print("%-10s : %s (%s)" % ('Func', data['cur_func'], enable_str))
+        for key, value in data['params'].iteritems():
+            print("  %-8s : %s" % (key, value))
+        print("%-10s : %s V" % ('V_in', v_in_str))
+        print("%-10s : %s V" % ('V_out', v_out_str))
+        print("%-10s : %s A" % ('I_out', i_out_str))
+        if 'temp1' in data:
+            print("%-10s : %.1f" % ('temp1', data['temp1']))
+        if 'temp2' in data:
+            print("%-10s : %.1f" % ('temp2', data['temp2']))
+
+def handle_upgrade_start_response(frame, args, ret_dict, json_dict):
+    #  *  DPS BL: [cmd_response | cmd_upgrade_start] [<upgrade_status_t>] [<chunk_size:16>]
+    cmd = frame.unpack8()
+    status = frame.unpack8()
+    chunk_size = frame.unpack16()
+    ret_dict["status"] = status
+    ret_dict["chunk_size"] = chunk_size
+
+def handle_upgrade_data_response(frame, args, ret_dict, json_dict):
+    cmd = frame.unpack8()
+    status = frame.unpack8()
+    ret_dict["status"] = status
+
+def handle_set_function_response(frame, args, ret_dict, json_dict):
+    cmd = frame.unpack8()
+    status = frame.unpack8()
+    if not status:
+        print("Function does not exist.") # Never reached due to status == 0
+    else:
+        print("Changed function.")
+
+def handle_list_functions_response(frame, args, ret_dict, json_dict):
+    cmd = frame.unpack8()
+    status = frame.unpack8()
+    if status == 0:
+        print("Error, failed to list available functions")
+    else:
+        functions = []
+        name = frame.unpack_cstr()
+        while name != "":
+            functions.append(name)
+            name = frame.unpack_cstr()
+        if args.json:
+            json_dict["functions"] = functions;
+        else:
+            if len(functions) == 0:
+                print("Selected OpenDPS supports no functions at all, which is quite weird when you think about it...")
+            elif len(functions) == 1:
+                print("Selected OpenDPS supports the %s function." % functions[0])
+            else:
+                temp = ", ".join(functions[:-1])
+                temp = "%s and %s" % (temp, functions[-1])
+                print("Selected OpenDPS supports the %s functions." % temp)
+
+def handle_set_parameters_response(frame, args, ret_dict, json_dict):
+    cmd = frame.unpack8()
+    status = frame.unpack8()
+    for p in args.parameter:
+        status = frame.unpack8()
+        parts = p.split("=")
+        # TODO: handle json output
+        print("%s: %s" % (parts[0], _PARAM_STATUS[status] if status < len(_PARAM_STATUS) else "unknown error %d" % (status)))
+
+def handle_list_parameters_response(frame, args, ret_dict, json_dict):
+    cmd = frame.unpack8()
+    status = frame.unpack8()
+    if status == 0:
+        print("Error, failed to list available parameters")
+    else:
+        cur_func = frame.unpack_cstr()
+        parameters = []
+        while not frame.eof():
+            parameter = {}
+            parameter['name'] = frame.unpack_cstr()
+            parameter['unit'] = unit_name(frame.unpack8())
+            parameter['prefix'] = prefix_name(frame.unpacks8())
+            parameters.append(parameter)
+        if args.json:
+            json_dict["current_function"] = cur_func;
+            json_dict["parameters"] = parameters
+        else:
+            if len(parameters) == 0:
+                print("Selected OpenDPS supports no parameters at all for the %s function" % (cur_func))
+            elif len(parameters) == 1:
+                print("Selected OpenDPS supports the %s parameter (%s%s) for the %s function." % (parameters[0]['name'], parameters[0]['prefix'], parameters[0]['unit'], cur_func))
+            else:
+                temp = ""
+                for p in parameters:
+                    temp += p['name'] + ' (%s%s)' % (p['prefix'], p['unit']) + " "
+                print("Selected OpenDPS supports the %sparameters for the %s function." % (temp, cur_func))
+
+def handle_enable_output_response(frame, args, ret_dict, json_dict):
+    cmd = frame.unpack8()
+    status = frame.unpack8()
+    if status == 0:
+        print("Error, failed to enable/disable output.")
+
+def handle_ignored_response(frame, args, ret_dict, json_dict):
+    pass
+
+_response_handlers = {
+    cmd_ping: handle_ping_response,
+    cmd_cal_report: handle_cal_report_response,
+    cmd_query: handle_query_response,
+    cmd_upgrade_start: handle_upgrade_start_response,
+    cmd_upgrade_data: handle_upgrade_data_response,
+    cmd_set_function: handle_set_function_response,
+    cmd_list_functions: handle_list_functions_response,
+    cmd_set_parameters: handle_set_parameters_response,
+    cmd_list_parameters: handle_list_parameters_response,
+    cmd_enable_output: handle_enable_output_response,
+    cmd_temperature_report: handle_ignored_response,
+    cmd_lock: handle_ignored_response,
+}
 
 """
 Handle a response frame from the device.
@@ -219,127 +410,42 @@ def handle_response(command, frame, args):
         if resp_command !=  cmd_upgrade_start and resp_command != cmd_upgrade_data and not success:
             fail("command failed according to device")
 
+    _json = {}
     if args.json:
-        _json = {}
         _json["cmd"] = resp_command;
         _json["status"] = 1; # we're here aren't we?
 
-    if resp_command == cmd_ping:
-        print("Got pong from device")
-    elif resp_command == cmd_cal_report:
-        ret_dict = unpack_cal_report(frame)
-    elif resp_command == cmd_query:
-        data = unpack_query_response(frame)
-        enable_str = "on" if data['output_enabled'] else "temperature shutdown" if data['temp_shutdown'] == 1 else "off"
-        v_in_str = "%d.%02d" % (data['v_in']/1000, (data['v_in']%1000)/10)
-        v_out_str = "%d.%02d" % (data['v_out']/1000, (data['v_out']%1000)/10)
-        i_out_str = "%d.%03d" % (data['i_out']/1000, data['i_out']%1000)
-        if args.json:
-            _json = data
-        else:
-            print("%-10s : %s (%s)" % ('Func', data['cur_func'], enable_str))
-            for key, value in data['params'].iteritems():
-                print("  %-8s : %s" % (key, value))
-            print("%-10s : %s V" % ('V_in', v_in_str))
-            print("%-10s : %s V" % ('V_out', v_out_str))
-            print("%-10s : %s A" % ('I_out', i_out_str))
-            if 'temp1' in data:
-                print("%-10s : %.1f" % ('temp1', data['temp1']))
-            if 'temp2' in data:
-                print("%-10s : %.1f" % ('temp2', data['temp2']))
-
-    elif resp_command == cmd_upgrade_start:
-    #  *  DPS BL: [cmd_response | cmd_upgrade_start] [<upgrade_status_t>] [<chunk_size:16>]
-        cmd = frame.unpack8()
-        status = frame.unpack8()
-        chunk_size = frame.unpack16()
-        ret_dict["status"] = status
-        ret_dict["chunk_size"] = chunk_size
-    elif resp_command == cmd_upgrade_data:
-        cmd = frame.unpack8()
-        status = frame.unpack8()
-        ret_dict["status"] = status
-    elif resp_command == cmd_set_function:
-        cmd = frame.unpack8()
-        status = frame.unpack8()
-        if not status:
-            print("Function does not exist.") # Never reached due to status == 0
-        else:
-            print("Changed function.")
-    elif resp_command == cmd_list_functions:
-        cmd = frame.unpack8()
-        status = frame.unpack8()
-        if status == 0:
-            print("Error, failed to list available functions")
-        else:
-            functions = []
-            name = frame.unpack_cstr()
-            while name != "":
-                functions.append(name)
-                name = frame.unpack_cstr()
-            if args.json:
-                _json["functions"] = functions;
-            else:
-                if len(functions) == 0:
-                    print("Selected OpenDPS supports no functions at all, which is quite weird when you think about it...")
-                elif len(functions) == 1:
-                    print("Selected OpenDPS supports the %s function." % functions[0])
-                else:
-                    temp = ", ".join(functions[:-1])
-                    temp = "%s and %s" % (temp, functions[-1])
-                    print("Selected OpenDPS supports the %s functions." % temp)
-    elif resp_command == cmd_set_parameters:
-        cmd = frame.unpack8()
-        status = frame.unpack8()
-        for p in args.parameter:
-            status = frame.unpack8()
-            parts = p.split("=")
-            # TODO: handle json output
-            print("%s: %s" % (parts[0], "ok" if status == 0 else "unknown parameter" if status == 1 else "out of range" if status == 2 else "unsupported parameter" if status == 3 else "unknown error %d" % (status)))
-    elif resp_command == cmd_list_parameters:
-        cmd = frame.unpack8()
-        status = frame.unpack8()
-        if status == 0:
-            print("Error, failed to list available parameters")
-        else:
-            cur_func = frame.unpack_cstr()
-            parameters = []
-            while not frame.eof():
-                parameter = {}
-                parameter['name'] = frame.unpack_cstr()
-                parameter['unit'] = unit_name(frame.unpack8())
-                parameter['prefix'] = prefix_name(frame.unpacks8())
-                parameters.append(parameter)
-            if args.json:
-                _json["current_function"] = cur_func;
-                _json["parameters"] = parameters
-            else:
-                if len(parameters) == 0:
-                    print("Selected OpenDPS supports no parameters at all for the %s function" % (cur_func))
-                elif len(parameters) == 1:
-                    print("Selected OpenDPS supports the %s parameter (%s%s) for the %s function." % (parameters[0]['name'], parameters[0]['prefix'], parameters[0]['unit'], cur_func))
-                else:
-                    temp = ""
-                    for p in parameters:
-                        temp += p['name'] + ' (%s%s)' % (p['prefix'], p['unit']) + " "
-                    print("Selected OpenDPS supports the %sparameters for the %s function." % (temp, cur_func))
-    elif resp_command == cmd_enable_output:
-        cmd = frame.unpack8()
-        status = frame.unpack8()
-        if status == 0:
-            print("Error, failed to enable/disable output.")
-    elif resp_command == cmd_temperature_report:
-        pass
-    elif resp_command == cmd_lock:
-        pass
+    handler = _response_handlers.get(resp_command)
+    if handler:
+        handler(frame, args, ret_dict, _json)
     else:
         print("Unknown response %d from device." % (resp_command))
 
     if args.json:
+        import json
         print(json.dumps(_json, indent=4, sort_keys=True))
 
     return ret_dict
 
+_cmd_frames = {}
+
+"""
+Return the frame for a command without arguments. Such frames never change
+so each one is built once and then reused.
+"""
+def cached_cmd(cmd):
+    frame = _cmd_frames.get(cmd)
+    if frame is None:
+        frame = _cmd_frames[cmd] = create_cmd(cmd)
+    return frame
+
+"""
+Return data as a string of space separated hex bytes
+"""
+def hex_str(data):
+    h = binascii.hexlify(data).decode()
+    return " ".join(h[i:i + 2] for i in range(0, len(h), 2))
+
 """
 Communicate with the DPS device according to the user's whishes
 """
@@ -348,20 +454,21 @@ def communicate(comms, frame, args):
 
     if not comms:
         fail("no communication interface specified")
-    if not comms.open():
-        fail("could not open %s" % (comms.name()))
+    if not comms.is_open():
+        if not comms.open():
+            fail("could not open %s" % (comms.name()))
+        if args.verbose and comms.warning():
+            print("Warning: %s" % (comms.warning()))
     if args.verbose:
         print("Communicating with %s" % (comms.name()))
-        print("TX %2d bytes [%s]" % (len(bytes), " ".join("%02x" % b for b in bytes)))
+        print("TX %2d bytes [%s]" % (len(bytes), hex_str(bytes)))
     if not comms.write(bytes):
         fail("write failed on %s" % (comms.name()))
     resp = comms.read()
     if len(resp) == 0:
         fail("timeout talking to device %s" % (comms._if_name))
     elif args.verbose:
-        print("RX %2d bytes [%s]\n" % (len(resp), " ".join("%02x" % b for b in resp)))
-    if not comms.close:
-        print("Warning: could not close %s" % (comms.name()))
+        print("RX %2d bytes [%s]\n" % (len(resp), hex_str(resp)))
 
     f = uFrame()
     res = f.set_frame(resp)
@@ -379,91 +486,13 @@ def handle_commands(args):
         return
 
     comms = create_comms(args)
-    if args.init:
-        communicate(comms,create_cmd(cmd_init),args)
-        
-    if args.ping:
-        communicate(comms, create_cmd(cmd_ping), args)
-
-    if args.firmware:
-        run_upgrade(comms, args.firmware, args)
-
-    if args.lock:
-        communicate(comms, create_lock(1), args)
-        
-    if args.unlock:
-        communicate(comms, create_lock(0), args)
-
-    if args.list_functions:
-        communicate(comms, create_cmd(cmd_list_functions), args)
-
-    if args.list_parameters:
-        communicate(comms, create_cmd(cmd_list_parameters), args)
-
-    if args.function:
-        communicate(comms, create_set_function(args.function), args)
-
-    if args.enable:
-        if args.enable == 'on' or args.enable == 'off':
-            communicate(comms, create_enable_output(args.enable), args)
-        else:
-            fail("enable is 'on' or 'off'")
-            
-    if args.calibration_args:
-        payload = create_set_calibration(args.calibration_args)
-        if payload:
-            communicate(comms,payload,args)
-        else:
-            fail("malformatted parameters")
-    if args.calibration_report:
-        data = communicate(comms, create_cmd(cmd_cal_report), args)
-        print "Calibration Report:\r\n \
-        {} = {}\r\n \
-        {} = {}\r\n \
-        {} = {}\r\n \
-        {} = {}\r\n \
-        {} = {}\r\n \
-        {} = {}\r\n \
-        {} = {}\r\n \
-        {} = {}\r\n \
-        {} = {}\r\n \
-        {} = {}\r\n \
-        {} = {}\r\n \
-        {} = {}\r\n \
-        {} = {}\r\n \
-        {} = {}\r\n \
-        {} = {}".format(
-        "A_ADC_K",data['cal']['A_ADC_K'][0],
-        "A_ADC_C",data['cal']['A_ADC_C'][0],
-        "A_DAC_K",data['cal']['A_DAC_K'][0],
-        "A_DAC_C",data['cal']['A_DAC_C'][0],
-        "V_ADC_K",data['cal']['V_DAC_K'][0],
-        "V_ADC_C",data['cal']['V_DAC_C'][0],
-        "V_DAC_K",data['cal']['V_DAC_K'][0],
-        "V_DAC_C",data['cal']['V_DAC_C'][0],
-        "VIN_ADC_K",data['cal']['VIN_ADC_K'][0],
-        "VIN_ADC_C",data['cal']['VIN_ADC_C'][0],
-        "VIN_ADC",data['vin_adc'],
-        "VOUT_ADC",data['vout_adc'],
-        "IOUT_ADC",data['iout_adc'],
-        "IOUT_DAC",data['iout_dac'],
-        "VOUT_DAC",data['vout_dac'])
-        
-    if args.parameter:
-        payload = create_set_parameter(args.parameter)
-        if payload:
-            communicate(comms, payload, args)
-        else:
-            fail("malformatted parameters")
-
-    if args.query:
-        communicate(comms, create_cmd(cmd_query), args)
-
-    if hasattr(args, 'temperature') and args.temperature:
-        communicate(comms, create_temperature(float(args.temperature)), args)
-        
-    if args.calibrate:
-        do_calibration(comms,args)
+    # The interface is opened on first use and kept open for all actions
+    try:
+        for name, action in _actions:
+            if getattr(args, name):
+                action(comms, args)
+    finally:
+        comms.close()
 
 """
 Return True if the parameter if_name is an IP address.
@@ -475,39 +504,59 @@ def is_ip_address(if_name):
     except socket.error:
         return False
 
-# Darn beautiful, from SO: https://stackoverflow.com/a/1035456
-def chunk_from_file(filename, chunk_size):
-    with open(filename, "rb") as f:
-        while True:
-            chunk = f.read(chunk_size)
-            if chunk:
-                yield bytearray(chunk)
-            else:
-                break
+"""
+Build the upgrade data frames in the background so the next frame is ready
+by the time the device acks the current one. The stream ends with a None
+frame.
+"""
+def upgrade_frame_producer(content, chunk_size, frames):
+    for offset in range(0, len(content), chunk_size):
+        chunk = content[offset:offset + chunk_size]
+        frames.put((len(chunk), create_upgrade_data(chunk)))
+    frames.put((0, None))
 
 """
 Run OpenDPS firmware upgrade
 """
 def run_upgrade(comms, fw_file_name, args):
+    import threading
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue # Python 2
     with open(fw_file_name, mode='rb') as file:
-        #crc = binascii.crc32(file.read()) % (1<<32)
-        content = file.read()
-        if content.encode('hex')[6:8] != "20" and not args.force:
+        # Converted once, the upload slices chunks from it
+        content = bytearray(file.read())
+        if len(content) == 0:
+            fail("The firmware file is empty")
+        if content[3:4] != b"\x20" and not args.force:
             fail("The firmware file does not seem valid, use --force to force upgrade")
-        crc = CRCCCITT().calculate(content)
+        crc = binascii.crc_hqx(content, 0) # CRC-CCITT (XModem), same as crc16() in the bootloader
     chunk_size = 1024
     ret_dict = communicate(comms, create_upgrade_start(chunk_size, crc), args)
     if ret_dict["status"] == upgrade_continue:
         if chunk_size != ret_dict["chunk_size"]:
             print("Device selected chunk size %d" % (ret_dict["chunk_size"]))
+            chunk_size = ret_dict["chunk_size"]
+        frames = queue.Queue(maxsize = 2)
+        producer = threading.Thread(target = upgrade_frame_producer, args = (content, chunk_size, frames))
+        producer.daemon = True
+        producer.start()
         counter = 0
-        for chunk in chunk_from_file(fw_file_name, chunk_size):
-            counter += len(chunk)
-            sys.stdout.write("\rDownload progress: %d%% " % (counter*1.0/len(content)*100.0) )
-            sys.stdout.flush()
+        last_print = 0
+        while True:
+            length, frame = frames.get()
+            if frame is None:
+                break
+            counter += length
+            now = time.time()
+            if now - last_print > 0.1 or counter == len(content): # Flushing the tty per chunk is wasted effort
+                sys.stdout.write("\rDownload progress: %d%% " % (counter*1.0/len(content)*100.0) )
+                sys.stdout.flush()
+                last_print = now
 #            print(" %d bytes" % (counter))
 
-            ret_dict = communicate(comms, create_upgrade_data(chunk), args)
+            ret_dict = communicate(comms, frame, args)
             status = ret_dict["status"]
             if status == upgrade_continue:
                 pass
@@ -536,7 +585,7 @@ def run_upgrade(comms, fw_file_name, args):
 Run DPS calibration prompts
 """
 def do_calibration(comms,args):
-    data = communicate(comms, create_cmd(cmd_cal_report), args)
+    data = communicate(comms, cached_cmd(cmd_cal_report), args)
     print "Previous Calibration Constants:\r\n \
     {} = {}\r\n \
     {} = {}\r\n \
@@ -572,12 +621,12 @@ def do_calibration(comms,args):
         print "Please hook up the first lower supply voltage to the DPS now \r\n \
         ensuring that the serial connection is connected after boot"
         v1 = float(raw_input("Type input voltage in mV: "))
-        data1 = communicate(comms, create_cmd(cmd_cal_report), args)
+        data1 = communicate(comms, cached_cmd(cmd_cal_report), args)
         #Do second Voltage Hookup
         print "Please hook up the Second higher supply voltage to the DPS now \r\n \
         ensuring that the serial connection is connected after boot"
         v2 = float(raw_input("Type input voltage in mV: "))
-        data2 = communicate(comms, create_cmd(cmd_cal_report), args)
+        data2 = communicate(comms, cached_cmd(cmd_cal_report), args)
         
         #Math out the calibration constants
         k_adc = (v1-v2)/(data1['vin_adc']-data2['vin_adc'])
@@ -605,7 +654,7 @@ def do_calibration(comms,args):
             communicate(comms, payload, args)
         communicate(comms, create_enable_output("on"), args)             
         c1 = float(raw_input("Measured Voltage: "))
-        c1_data = communicate(comms, create_cmd(cmd_cal_report), args)
+        c1_data = communicate(comms, cached_cmd(cmd_cal_report), args)
         
         print "Cal Point 2, 90% of Max"
         args.parameter = ["voltage={}".format(max_v*.9)]
@@ -613,7 +662,7 @@ def do_calibration(comms,args):
         if payload:
             communicate(comms, payload, args)
         c2 = float(raw_input("Measured Voltage: "))
-        c2_data = communicate(comms, create_cmd(cmd_cal_report), args)
+        c2_data = communicate(comms, cached_cmd(cmd_cal_report), args)
         communicate(comms, create_enable_output("off"), args)             
         k_dac = (c1_data['vout_dac']-c2_data['vout_dac'])/(c1-c2)
         c_dac = c1_data['vout_dac']-k_dac*c1
@@ -652,7 +701,7 @@ def do_calibration(comms,args):
         raw_input("Please hook up load to DPS, Then press enter")
         communicate(comms, create_enable_output("on"), args)   
         os.sleep(.5) #wait for DPS to settle
-        c1_data = communicate(comms, create_cmd(cmd_cal_report), args)
+        c1_data = communicate(comms, cached_cmd(cmd_cal_report), args)
         communicate(comms, create_enable_output("off"), args)
         
         print "Cal Point 2, {}mV".format(max_v*.5)
@@ -665,7 +714,7 @@ def do_calibration(comms,args):
         raw_input("Please hook up load to DPS, Then press enter")
         communicate(comms, create_enable_output("on"), args)   
         os.sleep(.5) #wait for DPS to settle
-        c2_data = communicate(comms, create_cmd(cmd_cal_report), args)
+        c2_data = communicate(comms, cached_cmd(cmd_cal_report), args)
         communicate(comms, create_enable_output("off"), args)
         
         k_adc = (c1-c2)/(c1_data['iout_adc']-c2_data['iout_adc'])
@@ -683,6 +732,114 @@ def do_calibration(comms,args):
     if t.lower() != 'n' or t.lower() == 'y':
         pass
         
+"""
+Actions performed by handle_commands, one per command line option. Each one
+is called with the comms interface and the parsed arguments when its option
+is set.
+"""
+def do_init(comms, args):
+    communicate(comms, cached_cmd(cmd_init), args)
+
+def do_ping(comms, args):
+    communicate(comms, cached_cmd(cmd_ping), args)
+
+def do_upgrade(comms, args):
+    run_upgrade(comms, args.firmware, args)
+
+def do_lock(comms, args):
+    communicate(comms, create_lock(1), args)
+
+def do_unlock(comms, args):
+    communicate(comms, create_lock(0), args)
+
+def do_list_functions(comms, args):
+    communicate(comms, cached_cmd(cmd_list_functions), args)
+
+def do_list_parameters(comms, args):
+    communicate(comms, cached_cmd(cmd_list_parameters), args)
+
+def do_set_function(comms, args):
+    communicate(comms, create_set_function(args.function), args)
+
+def do_enable(comms, args):
+    if args.enable == 'on' or args.enable == 'off':
+        communicate(comms, create_enable_output(args.enable), args)
+    else:
+        fail("enable is 'on' or 'off'")
+
+def do_set_calibration(comms, args):
+    payload = create_set_calibration(args.calibration_args)
+    if payload:
+        communicate(comms,payload,args)
+    else:
+        fail("malformatted parameters")
+
+def do_calibration_report(comms, args):
+    data = communicate(comms, cached_cmd(cmd_cal_report), args)
+    print "Calibration Report:\r\n \
+        {} = {}\r\n \
+        {} = {}\r\n \
+        {} = {}\r\n \
+        {} = {}\r\n \
+        {} = {}\r\n \
+        {} = {}\r\n \
+        {} = {}\r\n \
+        {} = {}\r\n \
+        {} = {}\r\n \
+        {} = {}\r\n \
+        {} = {}\r\n \
+        {} = {}\r\n \
+        {} = {}\r\n \
+        {} = {}\r\n \
+        {} = {}".format(
+    "A_ADC_K",data['cal']['A_ADC_K'][0],
+    "A_ADC_C",data['cal']['A_ADC_C'][0],
+    "A_DAC_K",data['cal']['A_DAC_K'][0],
+    "A_DAC_C",data['cal']['A_DAC_C'][0],
+    "V_ADC_K",data['cal']['V_DAC_K'][0],
+    "V_ADC_C",data['cal']['V_DAC_C'][0],
+    "V_DAC_K",data['cal']['V_DAC_K'][0],
+    "V_DAC_C",data['cal']['V_DAC_C'][0],
+    "VIN_ADC_K",data['cal']['VIN_ADC_K'][0],
+    "VIN_ADC_C",data['cal']['VIN_ADC_C'][0],
+    "VIN_ADC",data['vin_adc'],
+    "VOUT_ADC",data['vout_adc'],
+    "IOUT_ADC",data['iout_adc'],
+    "IOUT_DAC",data['iout_dac'],
+    "VOUT_DAC",data['vout_dac'])
+
+def do_set_parameters(comms, args):
+    payload = create_set_parameter(args.parameter)
+    if payload:
+        communicate(comms, payload, args)
+    else:
+        fail("malformatted parameters")
+
+def do_query(comms, args):
+    communicate(comms, cached_cmd(cmd_query), args)
+
+def do_temperature(comms, args):
+    communicate(comms, create_temperature(float(args.temperature)), args)
+
+# (option, action) in the order the actions are performed
+_actions = (
+    ("init", do_init),
+    ("ping", do_ping),
+    ("firmware", do_upgrade),
+    ("lock", do_lock),
+    ("unlock", do_unlock),
+    ("list_functions", do_list_functions),
+    ("list_parameters", do_list_parameters),
+    ("function", do_set_function),
+    ("enable", do_enable),
+    ("calibration_args", do_set_calibration),
+    ("calibration_report", do_calibration_report),
+    ("parameter", do_set_parameters),
+    ("query", do_query),
+    ("temperature", do_temperature),
+    ("calibrate", do_calibration),
+)
+
 """
 Create and return a comminications interface object or None if no comms if
 was specified.
@@ -710,12 +867,19 @@ The worker thread used by uHej for service discovery
 def uhej_worker_thread():
     global discovery_list
     global sock
-    while 1:
+    global scan_done
+    import select
+    from uhej import uhej
+    rx_buffer = bytearray(65536)
+    while not scan_done.is_set():
         try:
-            data, addr = sock.recvfrom(1024)
+            readable, _, _ = select.select([sock], [], [], 0.1)
+            if not readable:
+                continue
+            length, addr = sock.recvfrom_into(rx_buffer)
             port = addr[1]
             addr = addr[0]
-            frame = bytearray(data)
+            frame = rx_buffer[:length]
             try:
                 f = uhej.decode_frame(frame)
                 f["source"] = addr
@@ -740,7 +904,11 @@ Scan for OpenDPS devices on the local network
 def uhej_scan():
     global discovery_list
     global sock
+    global scan_done
+    import threading
+    from uhej import uhej
     discovery_list = {}
+    scan_done = threading.Event()
 
     ANY = "0.0.0.0"
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
@@ -750,6 +918,7 @@ def uhej_scan():
         pass
     sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 32)
     sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
     sock.bind((ANY, uhej.MCAST_PORT))
 
     thread = threading.Thread(target = uhej_worker_thread)
@@ -760,15 +929,21 @@ def uhej_scan():
 
     run_time_s = 6 # Run query for this many seconds
     query_interval_s = 2 # Send query this often
-    last_query = 0
     start_time = time.time()
-
-    while time.time() - start_time < run_time_s:
-        if time.time() - last_query > query_interval_s:
+    next_query = start_time
+    deadline = start_time + run_time_s
+
+    while True:
+        now = time.time()
+        if now >= deadline:
+            break
+        if now >= next_query:
             f = uhej.query(uhej.UDP, "*")
             sock.sendto(f, (uhej.MCAST_GRP, uhej.MCAST_PORT))
-            last_query = time.time()
-        time.sleep(1)
+            next_query = now + query_interval_s
+        time.sleep(min(next_query, deadline) - now)
+    scan_done.set()
+    thread.join()
 
     num_found = len(discovery_list)
     if num_found == 0:
@@ -779,37 +954,128 @@ def uhej_scan():
         print("%d OpenDPS devices found" % (num_found))
 
 
+"""
+Return True if any of the command line arguments may refer to one of the
+given options. Short options are matched by letter to catch combined flags
+(eg. -vc) and long options by prefix as argparse accepts abbreviations.
+Matching too much is harmless, it just registers options that go unused.
+"""
+def sniff_options(argv, letters, long_options):
+    for arg in argv:
+        if arg.startswith("--"):
+            arg = arg.split("=", 1)[0]
+            for option in long_options:
+                if option.startswith(arg):
+                    return True
+        elif arg.startswith("-"):
+            for letter in letters:
+                if letter in arg[1:]:
+                    return True
+    return False
+
+# Command line options as (group, flags, keyword arguments to add_argument),
+# in the order they are listed by --help. The group decides when an option
+# is registered, see build_parser()
+_options = (
+    ('device', ('-d', '--device'), dict(help="OpenDPS device to connect to. Can be a /dev/tty device or an IP number. If omitted, dpsctl.py will try the environment variable DPSIF", default='')),
+    ('device', ('-S', '--scan'), dict(action="store_true", help="Scan for OpenDPS wifi devices")),
+    ('device', ('-f', '--function'), dict(nargs='?', help="Set active function")),
+    ('device', ('-F', '--list-functions'), dict(action='store_true', help="List available functions")),
+    ('device', ('-p', '--parameter'), dict(nargs='+', help="Set function parameter <name>=<value>")),
+    ('device', ('-P', '--list-parameters'), dict(action='store_true', help="List function parameters of active function")),
+    ('calibration', ('-c', '--calibrate'), dict(action="store_true", help="Starts System Calibration")),
+    ('calibration', ('-cr', '--calibration_report'), dict(action="store_true", help="Prints Calibration report")),
+    ('calibration', ('-C', '--calibration_args'), dict(nargs='+', help="Set calibration constants <name>=<value>")),
+    ('device', ('-o', '--enable'), dict(help="Enable output ('on' or 'off')")),
+    ('device', (      '--ping',), dict(action='store_true', help="Ping device (causes screen to flash)")),
+    ('device', ('-L', '--lock'), dict(action='store_true', help="Lock device keys")),
+    ('device', ('-l', '--unlock'), dict(action='store_true', help="Unlock device keys")),
+    ('device', ('-q', '--query'), dict(action='store_true', help="Query device settings and measurements")),
+    ('device', ('-j', '--json'), dict(action='store_true', help="Output parameters as JSON")),
+    ('device', ('-v', '--verbose'), dict(action='store_true', help="Verbose communications")),
+    ('firmware', ('-U', '--upgrade'), dict(type=str, dest="firmware", help="Perform upgrade of OpenDPS firmware")),
+    ('device', ('--init',), dict(action='store_true', help="Re-inits internal storage")),
+    ('firmware', (      '--force',), dict(action='store_true', help="Force upgrade even if dpsctl complains about the firmware")),
+    ('testing', ('-t', '--temperature'), dict(type=str, dest="temperature", help="Send temperature report (for testing)")),
+)
+
+"""
+Return a dictionary of the attribute names and default values argparse would
+give the options
+"""
+def option_defaults(options):
+    defaults = {}
+    for group, flags, kwargs in options:
+        dest = kwargs.get('dest')
+        if dest is None:
+            dest = [flag for flag in flags if flag.startswith('--')][0][2:].replace('-', '_')
+        defaults[dest] = kwargs.get('default', False if kwargs.get('action') == 'store_true' else None)
+    return defaults
+
+_parsers = {}
+
+# Value of every option when it is not given on the command line
+_default_args = option_defaults(_options)
+
+# Options common enough to be handled without argparse when given alone
+_fast_path_options = {
+    '--ping': 'ping',
+    '-q': 'query',
+    '--query': 'query',
+    '-L': 'lock',
+    '--lock': 'lock',
+    '-l': 'unlock',
+    '--unlock': 'unlock',
+}
+
+"""
+A minimal stand in for argparse.Namespace
+"""
+class fast_path_args(object):
+
+    def __init__(self, option):
+        self.__dict__.update(_default_args)
+        setattr(self, _fast_path_options[option], True)
+
+"""
+Return an argument parser with the device options and, if asked for, the
+calibration and firmware options. Options left out get their default values.
+Each combination is built once and then reused.
+"""
+def build_parser(calibration, firmware):
+    key = (calibration, firmware)
+    parser = _parsers.get(key)
+    if parser is None:
+        import argparse
+        parser = argparse.ArgumentParser(description='Instrument an OpenDPS device')
+        wanted = {'device': True, 'testing': TESTING, 'calibration': calibration, 'firmware': firmware}
+        unused = []
+        for option in _options:
+            group, flags, kwargs = option
+            if wanted[group]:
+                parser.add_argument(*flags, **kwargs)
+            else:
+                unused.append(option)
+        parser.set_defaults(**option_defaults(unused))
+        _parsers[key] = parser
+    return parser
+
 """
 Ye olde main
 """
 def main():
     global args
-    testing = '--testing' in sys.argv
-    parser = argparse.ArgumentParser(description='Instrument an OpenDPS device')
-
-    parser.add_argument('-d', '--device', help="OpenDPS device to connect to. Can be a /dev/tty device or an IP number. If omitted, dpsctl.py will try the environment variable DPSIF", default='')
-    parser.add_argument('-S', '--scan', action="store_true", help="Scan for OpenDPS wifi devices")
-    parser.add_argument('-f', '--function', nargs='?', help="Set active function")
-    parser.add_argument('-F', '--list-functions', action='store_true', help="List available functions")
-    parser.add_argument('-p', '--parameter', nargs='+', help="Set function parameter <name>=<value>")
-    parser.add_argument('-P', '--list-parameters', action='store_true', help="List function parameters of active function")
-    parser.add_argument('-c', '--calibrate', action="store_true", help="Starts System Calibration")
-    parser.add_argument('-cr', '--calibration_report', action="store_true", help="Prints Calibration report")
-    parser.add_argument('-C', '--calibration_args', nargs='+', help="Set calibration constants <name>=<value>")
-    parser.add_argument('-o', '--enable', help="Enable output ('on' or 'off')")
-    parser.add_argument(      '--ping', action='store_true', help="Ping device (causes screen to flash)")
-    parser.add_argument('-L', '--lock', action='store_true', help="Lock device keys")
-    parser.add_argument('-l', '--unlock', action='store_true', help="Unlock device keys")
-    parser.add_argument('-q', '--query', action='store_true', help="Query device settings and measurements")
-    parser.add_argument('-j', '--json', action='store_true', help="Output parameters as JSON")
-    parser.add_argument('-v', '--verbose', action='store_true', help="Verbose communications")
-    parser.add_argument('-U', '--upgrade', type=str, dest="firmware", help="Perform upgrade of OpenDPS firmware")
-    parser.add_argument('--init', action='store_true', help="Re-inits internal storage")
-    parser.add_argument(      '--force', action='store_true', help="Force upgrade even if dpsctl complains about the firmware")
-    if testing:
-        parser.add_argument('-t', '--temperature', type=str, dest="temperature", help="Send temperature report (for testing)")
-
-    args, unknown = parser.parse_known_args()
+    argv = sys.argv[1:]
+    if len(argv) == 1 and argv[0] in _fast_path_options:
+        # Skip importing argparse and building a parser for eg. 'dpsctl.py -q'
+        args = fast_path_args(argv[0])
+    else:
+        # Only register the calibration and firmware options when they might
+        # be used (or help is requested)
+        everything = sniff_options(argv, "h", ("--help",))
+        calibration = everything or sniff_options(argv, "cC", ("--calibrate", "--calibration_report", "--calibration_args"))
+        firmware = everything or sniff_options(argv, "U", ("--upgrade", "--force"))
+        args, unknown = build_parser(calibration, firmware).parse_known_args()
 
     try:
         handle_commands(args)
@@ -23,6 +23,7 @@ THE SOFTWARE.
 """
 
 from uframe import *
+import re
 import struct
 
 # command_t
@@ -109,17 +110,19 @@ def create_set_parameter(parameter_list):
     f.end()
     return f
 
+# <name>=<value> where value is a float, eg. V_ADC_K=1.5 or V_ADC_C=-2.1e-05
+_CAL_RE = re.compile(r'^\s*([A-Za-z_][A-Za-z0-9_]*)\s*=\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*$')
+
 def create_set_calibration(parameter_list):
-    pass
     f = uFrame()
     f.pack8(cmd_set_calibration)
     for p in parameter_list:
-        parts = p.split("=")
-        if len(parts) != 2:
+        m = _CAL_RE.match(p)
+        if not m:
             return None
         else:
-            f.pack_cstr(parts[0].lstrip().rstrip())
-            for t in bytearray(struct.pack("f",float(parts[1].lstrip().rstrip()))):
+            f.pack_cstr(m.group(1))
+            for t in bytearray(struct.pack("f",float(m.group(2)))):
                 f.pack8(t)
     f.pack8(0)
     f.end()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+"""
+Unit tests for dpsctl.py, run with 'python -m unittest test_dpsctl' from this
+directory.
+"""
+
+import unittest
+import dpsctl
+
+"""
+The fast path must give the same arguments as argparse would for the options
+it handles
+"""
+class test_fast_path(unittest.TestCase):
+
+    def setUp(self):
+        self._testing = dpsctl.TESTING
+
+    def tearDown(self):
+        dpsctl.TESTING = self._testing
+        dpsctl._parsers.clear()
+
+    def check_options(self, testing):
+        dpsctl.TESTING = testing
+        dpsctl._parsers.clear()
+        parser = dpsctl.build_parser(False, False)
+        for option in dpsctl._fast_path_options:
+            expected = vars(parser.parse_known_args([option])[0])
+            self.assertEqual(vars(dpsctl.fast_path_args(option)), expected, option)
+
+    def test_fast_path_args(self):
+        self.check_options(False)
+
+    def test_fast_path_args_testing(self):
+        self.check_options(True)
+
+if __name__ == '__main__':
+    unittest.main()
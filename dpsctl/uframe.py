@@ -22,6 +22,8 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
+import binascii
+
 _SOF = 0x7e
 _DLE = 0x7d
 _XOR = 0x20
@@ -131,27 +133,24 @@ class uFrame(object):
             return -E_LEN
         if self._frame[0] != _SOF or self._frame[length-1] != _EOF:
             return -E_FRM
-        f = bytearray()
-        seen_dle = False
-        for b in self._frame:
-            if b == _DLE:
-                seen_dle = True
-            elif seen_dle:
-                f.append(b ^ _XOR)
-                seen_dle = False
-            else:
-                f.append(b)
-        self._frame = f[1:-1]
+        # Split on DLE so that only escaped bytes are touched in Python, the
+        # first byte of every part but the first one is the escaped byte
+        parts = self._frame[1:-1].split(bytearray([_DLE]))
+        f = parts[0]
+        for part in parts[1:]:
+            if part:
+                f.append(part[0] ^ _XOR)
+                f += part[1:]
+            # else: DLE DLE, the second DLE escapes the byte after it
+        self._frame = f
         return 0
 
     """
     Check crc of frame data and chop crc off payload if valid (internal function)
     """
     def _calc_crc(self):
-        self._crc = 0
-        for b in self._frame[:-2]:
-            self._crc = crc16_ccitt(self._crc, b)
-        self._crc &= 0xffff
+        # crc_hqx is the same CRC-CCITT as crc16_ccitt(...), just in C
+        self._crc = binascii.crc_hqx(self._frame[:-2], 0)
         crc = (self._frame[-2] << 8) | self._frame[-1]
         self._valid = crc == self._crc
         if not self._valid: